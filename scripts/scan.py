@@ -3,19 +3,158 @@
 
 import subprocess
 import argparse
+import re
 import base64
 import time
+import mmap
+import sys
 import os
+import socket
+from collections import deque
 from lxml import etree
+from lxml.builder import E
 from typing import Optional
 from typing import Union
 from typing import Dict
 from typing import List
 from typing import Set
-from typing import IO
+from typing import Callable
+from typing import Deque
 
 DEBUG: bool = False
 
+GVMD_SOCKET: str = "/usr/local/var/run/gvmd.sock"
+GVMD_USERNAME: str = "admin"
+GVMD_PASSWORD: str = "admin"
+
+GMP_RECV_SIZE: int = 64 * 1024
+GMP_TIMEOUT: float = 60.0
+GMP_PIPELINE_DEPTH: int = 64
+
+OPENVAS_CONFIG: str = "/usr/local/etc/openvas/openvas.conf"
+
+_MAX_HOSTS_RE = re.compile(r"max_hosts.*")
+_MAX_CHECKS_RE = re.compile(r"max_checks.*")
+
+REPORT_CHUNK_SIZE: int = 64 * 1024
+LOG_TAIL_SIZE: int = 64 * 1024
+
+POLL_MIN_INTERVAL: float = 1.0
+POLL_MAX_INTERVAL: float = 30.0
+POLL_BACKOFF: float = 1.5
+POLL_FINISH_INTERVAL: float = 2.0
+POLL_PROGRESS_STEP: int = 5
+
+_GET_TASKS_CMD: bytes = b'<get_tasks details="0" filter="rows=-1"/>'
+_GET_TARGETS_CMD: bytes = b'<get_targets filter="rows=-1"/>'
+_GET_TASK_TMPL: bytes = b'<get_tasks task_id="%b" details="0" schedules_only="0"/>'
+_START_TASK_TMPL: bytes = b'<start_task task_id="%b"/>'
+_DELETE_TASK_TMPL: bytes = b'<delete_task task_id="%b" ultimate="true"/>'
+_DELETE_TARGET_TMPL: bytes = b'<delete_target target_id="%b" ultimate="true"/>'
+_CREATE_TASK_TMPL: bytes = b'<create_task><name>scan</name><target id="%b"/><config id="%b"/></create_task>'
+_GET_REPORTS_TMPL: bytes = (b'<get_reports report_id="%b" format_id="%b" '
+                            b'filter="apply_overrides=1 overrides=1 notes=1 levels=hmlg" '
+                            b'details="1" notes_details="1" result_tags="1" ignore_pagination="1"/>')
+
+_XP: Dict[str, etree.XPath] = {
+    "task_ids": etree.XPath("task/@id"),
+    "target_ids": etree.XPath("target/@id"),
+    "create_task_id": etree.XPath("string(@id)"),
+    "create_target_id": etree.XPath("string(@id)"),
+    "report_text": etree.XPath("string(text())"),
+    "status": etree.XPath("string(.//status/text())"),
+    "progress": etree.XPath("string(.//progress/text())"),
+    "report_id": etree.XPath("string(.//report/@id)"),
+}
+
+
+class GmpError(Exception):
+    """GVMD rejected command or closed connection."""
+
+
+class GmpSocket:
+    """Persistent GMP session over GVMD Unix socket."""
+
+    def __init__(self, path: str):
+        self._socket: socket.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(GMP_TIMEOUT)
+
+        try:
+            self._socket.connect(path)
+        except OSError:
+            self._socket.close()
+
+            raise
+
+        self._parser: etree.XMLPullParser = etree.XMLPullParser(
+            events=("start", "end"), huge_tree=True, remove_blank_text=True,
+            collect_ids=False, resolve_entities=False)
+        self._depth: int = 0
+        self._responses: Deque[etree.Element] = deque()
+
+        # Responses are parsed as children of one synthetic root, so a single pull parser
+        # frames any number of them on the stream without knowing their length.
+        self._parser.feed(b"<gmp>")
+
+    def __enter__(self) -> "GmpSocket":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close GVMD socket."""
+        self._socket.close()
+
+    def send(self, command: bytes) -> None:
+        """Write command to GVMD without waiting for response."""
+        self._socket.sendall(command)
+
+    def read(self) -> etree.Element:
+        """Return next complete response, receiving more data from GVMD if needed. Raise if it is not 2xx."""
+        while not self._responses:
+            data: bytes = self._socket.recv(GMP_RECV_SIZE)
+
+            if not data:
+                raise GmpError("GVMD closed the connection.")
+
+            try:
+                self._parser.feed(data)
+            except etree.XMLSyntaxError as e:
+                raise GmpError("Malformed response from GVMD: {}".format(e))
+
+            for event, element in self._parser.read_events():
+                if event == "start":
+                    self._depth += 1
+                    continue
+
+                self._depth -= 1
+
+                if self._depth == 1:
+                    element.getparent().remove(element)
+                    self._responses.append(element)
+
+        response: etree.Element = self._responses.popleft()
+        status: str = response.get("status", "")
+
+        if not status.startswith("2"):
+            raise GmpError("{} {}: {}".format(response.tag, status, response.get("status_text", "")))
+
+        return response
+
+    def command(self, command: bytes) -> etree.Element:
+        """Send command and return its response."""
+        self.send(command)
+
+        return self.read()
+
+    def authenticate(self, username: str, password: str) -> None:
+        """Authenticate session, required once before any other command."""
+        self.command(etree.tostring(E.authenticate(E.credentials(E.username(username), E.password(password)))))
+
+
+GMP: Optional[GmpSocket] = None
+
 scan_profiles: Dict[str, str] = {
     "Discovery": "8715c877-47a0-438d-98a3-27c7a6ab2196",
     "Empty": "085569ce-73ed-11df-83c3-002264764cea",
@@ -57,139 +196,233 @@ alive_tests: Set[str] = {
 
 
 def check_error(error: str):
-    """Print exception error and exit. Ignore OpenVAS temporary authentication error."""
-    if 'Failed to authenticate.' not in error:
-        print("[ERROR] Response: {}".format(error))
-        exit(1)
+    """Print exception error and exit."""
+    print("[ERROR] Response: {}".format(error))
+    exit(1)
 
 
-def execute_command(command: str, xpath: Optional[str] = None) -> Union[str, float, bool, List]:
-    """Execute GVMD command and return its output (optionally xpath can be used to get nested XML element)."""
+def execute_command(command: bytes,
+                    xpath: Optional[Union[str, etree.XPath]] = None) -> Union[etree.Element, str, float, bool, List]:
+    """Execute GVMD command and return its output (optionally xpath key or compiled xpath can be used)."""
     global DEBUG
 
-    command: str = "su - service -c \"gvm-cli --gmp-username admin --gmp-password admin " \
-                   "socket --socketpath /usr/local/var/run/gvmd.sock --xml \'{}\'\"".format(command)
+    if DEBUG:
+        print("[DEBUG] Command: {}".format(command.decode()))
+
+    try:
+        response: etree.Element = GMP.command(command)
+    except (GmpError, OSError) as e:
+        check_error(str(e))
+
+        raise
 
     if DEBUG:
-        print("[DEBUG] Command: {}".format(command))
+        print("[DEBUG] Response: {}".format(etree.tostring(response).decode()))
+
+    if xpath is None:
+        return response
+
+    return (_XP[xpath] if isinstance(xpath, str) else xpath)(response)
 
-    response: str = ''
 
+def queue_commands(commands: List[bytes]) -> None:
+    """Send GVMD commands without reading their responses."""
     try:
-        response = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True).decode().strip()
-    except subprocess.CalledProcessError as e:
-        check_error(e.output.decode('utf-8'))
+        for command in commands:
+            if DEBUG:
+                print("[DEBUG] Command: {}".format(command.decode()))
 
-    if DEBUG:
-        print("[DEBUG] Response: {}".format(response))
+            GMP.send(command)
+    except (GmpError, OSError) as e:
+        check_error(str(e))
+
+        raise
+
+
+def read_responses(count: int) -> List[etree.Element]:
+    """Read responses of specified number of queued GVMD commands in order."""
+    responses: List[etree.Element] = []
+
+    try:
+        for _ in range(count):
+            responses.append(GMP.read())
+
+            if DEBUG:
+                print("[DEBUG] Response: {}".format(etree.tostring(responses[-1]).decode()))
+    except (GmpError, OSError) as e:
+        check_error(str(e))
+
+        raise
+
+    return responses
+
+
+def execute_commands(commands: List[bytes]) -> List[etree.Element]:
+    """Execute GVMD commands back to back and return their responses in order."""
+    responses: List[etree.Element] = []
+
+    for start in range(0, len(commands), GMP_PIPELINE_DEPTH):
+        batch: List[bytes] = commands[start:start + GMP_PIPELINE_DEPTH]
+
+        queue_commands(batch)
+        responses.extend(read_responses(len(batch)))
+
+    return responses
+
+
+def cleanup_commands() -> List[bytes]:
+    """Return commands removing all existing tasks and then all existing targets."""
+    tasks, targets = execute_commands([_GET_TASKS_CMD, _GET_TARGETS_CMD])
 
-    return etree.XML(response).xpath(xpath) if xpath else response
+    return [_DELETE_TASK_TMPL % task_id.encode() for task_id in _XP["task_ids"](tasks)] + \
+           [_DELETE_TARGET_TMPL % target_id.encode() for target_id in _XP["target_ids"](targets)]
 
 
 def perform_cleanup() -> None:
     """Remove all existing tasks and targets."""
-    existing_tasks: List = execute_command(r"<get_tasks/>", "//get_tasks_response/task")
+    execute_commands(cleanup_commands())
 
-    for task in existing_tasks:
-        execute_command(r"<delete_task task_id=\"{}\" ultimate=\"true\"/>".format(task.get("id")))
 
-    existing_targets: List = execute_command(r"<get_targets/>", "//get_targets_response/target")
+def print_log_tail(name: str, path: str) -> None:
+    """Print trailing part of log file without reading whole file."""
+    print("[DEBUG] {} Logs: ".format(name), end="")
+    sys.stdout.flush()
 
-    for target in existing_targets:
-       execute_command(r"<delete_target target_id=\"{}\" ultimate=\"true\"/>".format(target.get("id")))
+    with open(path, "rb") as file:
+        size: int = os.fstat(file.fileno()).st_size
+
+        if size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+                sys.stdout.buffer.write(log[max(0, size - LOG_TAIL_SIZE):size])
+
+    sys.stdout.buffer.write(b"\n")
+    sys.stdout.flush()
 
 
 def print_logs() -> None:
     """Show logs from OpenVAS and GVMD."""
     if DEBUG:
-        logs: str = open("/usr/local/var/log/gvm/openvas.log", "r").read()
+        print_log_tail("OpenVAS", "/usr/local/var/log/gvm/openvas.log")
+        print_log_tail("GVMD", "/usr/local/var/log/gvm/gvmd.log")
 
-        print("[DEBUG] OpenVAS Logs: {}".format(logs))
 
-        logs: str = open("/usr/local/var/log/gvm/gvmd.log", "r").read()
+def save_report(path: str, report: etree.Element, output_format: str) -> None:
+    """Save report to specified file. Decode from Base64 if not XML."""
+    with open(path, 'wb') as file:
+        if output_format == 'a994b278-1f62-11e1-96ac-406186ea4fc5':
+            etree.ElementTree(report).write(file, encoding="utf-8", xml_declaration=True)
 
-        print("[DEBUG] GVMD Logs: {}".format(logs))
+            return
 
+        content: str = _XP["report_text"](report)
+        report.clear()
 
-def save_report(path: str, report: str) -> None:
-    """Save report to specified file."""
-    file: IO[str] = open(path, 'wb')
-    file.write(report)
-    file.close()
+        carry: str = ""
 
+        # Whitespace is dropped and an incomplete quantum is carried over, so every slice is 4-character aligned.
+        for start in range(0, len(content), REPORT_CHUNK_SIZE):
+            chunk: str = carry + "".join(content[start:start + REPORT_CHUNK_SIZE].split())
+            aligned: int = len(chunk) - len(chunk) % 4
 
-def get_report(report_id: str, output_format: str) -> Optional[str]:
-    """Get generated report. Decode from Base64 if not XML."""
-    command: str = r"<get_reports report_id=\"{}\" format_id=\"{}\" ".format(report_id, output_format) + \
-                   r"filter=\"apply_overrides=1 overrides=1 notes=1 levels=hmlg\" " + \
-                   r"details=\"1\" notes_details=\"1\" result_tags=\"1\" ignore_pagination=\"1\"/>"
+            file.write(base64.b64decode(chunk[:aligned]))
+            carry = chunk[aligned:]
 
-    try:
-        if output_format == 'a994b278-1f62-11e1-96ac-406186ea4fc5':
-            report: etree.Element = execute_command(command, '//get_reports_response/report')[0]
-        else:
-            report: str = execute_command(command, 'string(//get_reports_response/report/text())')
-    except etree.XMLSyntaxError:
-        print("Generated report is empty!")
+        if carry:
+            file.write(base64.b64decode(carry))
 
-        return None
 
-    return base64.b64decode(report) if isinstance(report, str) else etree.tostring(report).strip()
+def get_report(report_id: str, output_format: str) -> Optional[etree.Element]:
+    """Get generated report."""
+    command: bytes = _GET_REPORTS_TMPL % (report_id.encode(), output_format.encode())
+    report: Optional[etree.Element] = execute_command(command).find("report")
+
+    if report is None:
+        print("Generated report is empty!")
+
+    return report
 
 
 def process_task(task_id: str) -> str:
     """Wait for task to finish and return report id."""
     status: Optional[str] = None
-    task: Optional[str] = None
+    task_el: Optional[etree.Element] = None
+    progress: int = 0
+    last_progress: int = 0
+    interval: float = POLL_MIN_INTERVAL
+    deadline: float = time.monotonic() + interval
 
     while status != "Done":
-        try:
-            time.sleep(10)
+        time.sleep(max(0.0, deadline - time.monotonic()))
+
+        task_el = execute_command(_GET_TASK_TMPL % task_id.encode())
+        status = _XP["status"](task_el)
+        progress = int(_XP["progress"](task_el))
+
+        if progress > 0:
+            sys.stdout.write("\rTask status: {} {}%   ".format(status, progress))
+        else:
+            sys.stdout.write("\rTask status: Complete   ")
+
+        sys.stdout.flush()
+
+        if progress - last_progress >= POLL_PROGRESS_STEP:
+            last_progress = progress
+            interval = POLL_MIN_INTERVAL
+        else:
+            interval = min(POLL_MAX_INTERVAL, interval * POLL_BACKOFF)
 
-            task = execute_command(r"<get_tasks task_id=\"{}\"/>".format(task_id))
-            status = etree.XML(task).xpath("string(//status/text())")
-            progress: int = int(etree.XML(task).xpath("string(//progress/text())"))
+        if progress >= 99:
+            interval = POLL_FINISH_INTERVAL
 
-            os.system("clear")
+        deadline = max(deadline + interval, time.monotonic() + POLL_MIN_INTERVAL)
 
-            if progress > 0:
-                print("Task status: {} {}%".format(status, progress))
-            else:
-                print("Task status: Complete")
-        except subprocess.CalledProcessError as exception:
-            print("ERROR: ", exception.output)
-        except etree.XMLSyntaxError:
-            print("ERROR: Cannot get task status")
+    sys.stdout.write("\n")
 
-    return etree.XML(task).xpath("string(//report/@id)")
+    return _XP["report_id"](task_el)
 
 
 def start_task(task_id) -> None:
     """Start task with specified id."""
-    execute_command(r"<start_task task_id=\"{}\"/>".format(task_id))
+    execute_command(_START_TASK_TMPL % task_id.encode())
 
 
 def create_task(profile, target_id) -> str:
     """Create new scan task for target."""
-    command: str = r"<create_task><name>scan</name>" + \
-                   r"<target id=\"{}\"></target>".format(target_id) + \
-                   r"<config id=\"{}\"></config></create_task>".format(profile)
-
-    return execute_command(command, "string(//create_task_response/@id)")
+    return execute_command(_CREATE_TASK_TMPL % (target_id.encode(), profile.encode()), "create_task_id")
 
 
 def create_target(scan) -> str:
     """Create new target."""
-    command: str = r"<create_target><name>scan</name><hosts>{0}</hosts>".format(scan['target']) + \
-                   r"<port_list id=\"{}\"></port_list>".format(scan['port_list_id']) + \
-                   r"<exclude_hosts>{}</exclude_hosts>".format(scan['exclude']) + \
-                   r"<live_tests>{}</live_tests></create_target>".format(scan['tests'])
+    command: bytes = etree.tostring(E.create_target(E.name("scan"), E.hosts(scan['target']),
+                                                    E.port_list(id=scan['port_list_id']),
+                                                    E.exclude_hosts(scan['exclude']),
+                                                    E.live_tests(scan['tests'])))
 
-    return execute_command(command, "string(//create_target_response/@id)")
+    return execute_command(command, "create_target_id")
 
 
 def make_scan(scan: Dict[str, str]) -> None:
     """Make automated OpenVAS scan and save generated report."""
+    global GMP
+
+    try:
+        GMP = GmpSocket(GVMD_SOCKET)
+    except OSError as e:
+        check_error(str(e))
+
+        raise
+
+    with GMP:
+        try:
+            GMP.authenticate(GVMD_USERNAME, GVMD_PASSWORD)
+        except (GmpError, OSError) as e:
+            check_error(str(e))
+
+        run_scan(scan)
+
+
+def run_scan(scan: Dict[str, str]) -> None:
+    """Run scan steps over opened GMP session."""
     perform_cleanup()
     print("Performed initial cleanup.")
 
@@ -209,15 +442,39 @@ def make_scan(scan: Dict[str, str]) -> None:
     report = get_report(report_id, scan['format'])
     print("Generated report.")
 
-    if report:
-        save_report(scan['output'], report)
+    # Final cleanup is only queued here and its responses are read once report is written to disk. Larger
+    # cleanups are executed right away, so unread responses cannot fill the socket buffers.
+    cleanup: List[bytes] = cleanup_commands()
+
+    if len(cleanup) <= GMP_PIPELINE_DEPTH:
+        queue_commands(cleanup)
+    else:
+        execute_commands(cleanup)
+
+    if report is not None:
+        save_report(scan['output'], report, scan['format'])
         print("Saved report to {}.".format(scan['output']))
 
+    if len(cleanup) <= GMP_PIPELINE_DEPTH:
+        read_responses(len(cleanup))
+
     print_logs()
-    perform_cleanup()
+
     print("Done!")
 
 
+def update_config(hosts: int, checks: int) -> None:
+    """Set maximum number of simultaneous tested hosts and checks in OpenVAS config."""
+    with open(OPENVAS_CONFIG, "r") as file:
+        config: str = file.read()
+
+    config = _MAX_HOSTS_RE.sub("max_hosts = {}".format(hosts), config)
+    config = _MAX_CHECKS_RE.sub("max_checks = {}".format(checks), config)
+
+    with open(OPENVAS_CONFIG, "w") as file:
+        file.write(config)
+
+
 def start_scan(args: argparse.Namespace) -> None:
     """Override default settings and start scan."""
     global DEBUG
@@ -225,16 +482,7 @@ def start_scan(args: argparse.Namespace) -> None:
     if args.debug:
         DEBUG = True
 
-    subprocess.check_call(
-        ["sed -i 's/max_hosts.*/max_hosts = " + str(args.hosts) + "/' /usr/local/etc/openvas/openvas.conf"],
-        shell=True,
-        stdout=subprocess.DEVNULL
-    )
-    subprocess.check_call(
-        ["sed -i 's/max_checks.*/max_checks = " + str(args.checks) + "/' /usr/local/etc/openvas/openvas.conf"],
-        shell=True,
-        stdout=subprocess.DEVNULL
-    )
+    update_config(args.hosts, args.checks)
 
     if args.update is True:
         print("Starting and updating OpenVAS...")
@@ -254,66 +502,29 @@ def start_scan(args: argparse.Namespace) -> None:
     print("* Report format: {}".format(args.format))
     print("* Output file: {}\n".format(args.output))
 
-    make_scan({'target': args.target, 'exclude': args.exclude, 'tests': args.tests.replace("&", "&amp;"),
+    make_scan({'target': args.target, 'exclude': args.exclude, 'tests': args.tests,
                'profile': scan_profiles[args.profile], 'port_list_id': scan_ports[args.ports],
                'format': report_formats[args.format], 'output': "/reports/" + args.output})
 
 
-def report_format(arg: Optional[str]) -> str:
-    """Check if report format value is valid."""
-    if arg not in report_formats:
-        raise argparse.ArgumentTypeError("Specified report format is invalid!")
-
-    return arg
-
-
-def scan_profile(arg: Optional[str]) -> str:
-    """Check if scan profile value is valid."""
-    if arg not in scan_profiles:
-        raise argparse.ArgumentTypeError("Specified scan profile is invalid!")
-
-    return arg
-
-def scan_ports_option(arg: Optional[str]) -> str:
-    """Check if scan ports value is valid."""
-    if arg not in scan_ports:
-        raise argparse.ArgumentTypeError("Specified scan ports option is invalid!")
-
-    return arg
-
-
-def alive_test(arg: Optional[str]) -> str:
-    """Check if alive test value is valid."""
-    if arg not in alive_tests:
-        raise argparse.ArgumentTypeError("Specified alive tests are invalid!")
-
-    return arg
-
-
-def max_hosts(arg: Optional[str]) -> int:
-    """Check if max hosts value is valid."""
-    try:
-        value = int(arg)
-
-        if value <= 0:
-            raise ValueError
-    except ValueError:
-        raise argparse.ArgumentTypeError("Specified maximum number of simultaneous tested hosts is invalid!")
+def positive_int_validator(error: str) -> Callable[[Optional[str]], int]:
+    """Create argument type checking if value is a positive integer."""
+    def validate(arg: Optional[str]) -> int:
+        try:
+            value = int(arg)
 
-    return value
+            if value <= 0:
+                raise ValueError
+        except ValueError:
+            raise argparse.ArgumentTypeError(error)
 
+        return value
 
-def max_checks(arg: Optional[str]) -> int:
-    """Check if max checks value is valid."""
-    try:
-        value = int(arg)
+    return validate
 
-        if value <= 0:
-            raise ValueError
-    except ValueError:
-        raise argparse.ArgumentTypeError("Specified maximum number of simultaneous checks against hosts is invalid!")
 
-    return value
+max_hosts = positive_int_validator("Specified maximum number of simultaneous tested hosts is invalid!")
+max_checks = positive_int_validator("Specified maximum number of simultaneous checks against hosts is invalid!")
 
 
 def parse_arguments():
@@ -324,13 +535,15 @@ def parse_arguments():
     parser.add_argument('-o', '--output', help='output file (default: openvas.report)',
                         default="openvas.report", required=False)
     parser.add_argument('-f', '--format', help='format for report (default: XML)',
-                        default="XML", type=report_format, required=False)
+                        default="XML", choices=report_formats.keys(), metavar='FORMAT', required=False)
     parser.add_argument('-p', '--profile', help='scan profile (default: )',
-                        default="Full and fast", type=scan_profile, required=False)
+                        default="Full and fast", choices=scan_profiles.keys(), metavar='PROFILE', required=False)
     parser.add_argument('-P', '--ports', help='scan ports (default: All TCP and Nmap top 100 UDP)',
-                        default="All TCP and Nmap top 100 UDP", type=scan_ports_option, required=False)
+                        default="All TCP and Nmap top 100 UDP", choices=scan_ports.keys(), metavar='PORTS',
+                        required=False)
     parser.add_argument('-t', '--tests', help='alive tests (default: ICMP, TCP-ACK Service & ARP Ping)',
-                        default="ICMP, TCP-ACK Service & ARP Ping", type=alive_test, required=False)
+                        default="ICMP, TCP-ACK Service & ARP Ping", choices=sorted(alive_tests), metavar='TESTS',
+                        required=False)
     parser.add_argument('-e', '--exclude', help='hosts excluded from scan target (Default: "")',
                         default="", required=False)
     parser.add_argument('-m', '--hosts', help='maximum number of simultaneous tested hosts (Default: 15)',